@@ -1,88 +1,132 @@
-from math import sqrt
+import os
+import pathlib
+from concurrent.futures import ThreadPoolExecutor
+import matplotlib
+matplotlib.use('Agg')
 from matplotlib import pyplot
 import numpy as np
-from pandas import DataFrame
-from pandas import Series
-from pandas import concat
 from pandas import read_csv
-from pandas import datetime
-from sklearn.metrics import mean_squared_error
-r=[]
-m=[]
-n=[]
-e=[]
-count=1
-count1=1
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+
+def load_column(path):
+    return read_csv(path, header=None, dtype=np.float64, engine='c', memory_map=True).values[:, 0]
+
+
+def _series_metrics_numpy(O, P):
+    # 每行一个序列，返回各序列的 mse, rmse, nmse
+    diff = O - P
+    mse = np.einsum('ij,ij->i', diff, diff) / O.shape[1]
+    dev = P - O.mean(axis=1, keepdims=True)  # 对每个origin求取均值
+    nmse = mse / np.einsum('ij,ij->i', dev, dev)  # 分母直接取平方和，省去开方再平方
+    return mse, np.sqrt(mse), nmse
+
+
+if njit is not None:
+    # 安装了numba时改用编译内核：减、平方、求和在一趟循环内完成，不产生中间数组，序列间并行
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _series_metrics_numba(O, P):
+        count, length = O.shape
+        mse = np.empty(count)
+        nmse = np.empty(count)
+        for i in prange(count):
+            meanV = 0.0
+            for j in range(length):
+                meanV += O[i, j]
+            meanV /= length
+            s = 0.0
+            d2 = 0.0
+            for j in range(length):
+                e = O[i, j] - P[i, j]
+                s += e * e
+                d = P[i, j] - meanV
+                d2 += d * d
+            mse[i] = s / length
+            nmse[i] = s / (length * d2)
+        return mse, np.sqrt(mse), nmse
+
+    series_metrics = _series_metrics_numba
+else:
+    series_metrics = _series_metrics_numpy
+
+
 dataset_name="CLOSING"
 dataset_name1="closing"
+origin_fmt = f'./LSTMSNPCell/{dataset_name}/origin/{{}}_{dataset_name1}.csv'
+prediction_fmt = f'./LSTMSNPCell/{dataset_name}/prediction/{{}}_{dataset_name1}.csv'
+origin_files = [origin_fmt.format(i+1) for i in range(30)]
+prediction_files = [prediction_fmt.format(i+1) for i in range(30)]
+# 解析后的结果缓存为npz，CSV未更新时直接加载，避免重复解析文本
+cache = f'./LSTMSNPCell/{dataset_name}/{dataset_name1}.npz'
+O = P = None
+if os.path.exists(cache) and os.path.getmtime(cache) >= max(os.path.getmtime(f) for f in origin_files + prediction_files):
+    with np.load(cache) as z:
+        # 早先按float32缓存的结果精度不足，需要重新解析
+        if z['O'].dtype == np.float64:
+            O, P = z['O'], z['P']
+if O is None:
+    # 各文件相互独立，用线程池并行读取，map按提交顺序返回结果
+    # 所有序列等长，逐个写入 (60, length) 的二维数组，省去列表和np.stack的二次拷贝
+    # map会一次提交全部任务，已完成的列在被取走前仍驻留内存，因此峰值内存并未减少
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for k, column in enumerate(executor.map(load_column, origin_files + prediction_files)):
+            if k == 0:
+                OP = np.empty((60, len(column)), dtype=np.float64)
+            OP[k] = column
+    O, P = OP[:30], OP[30:]
+    np.savez(cache, O=O, P=P)
+m, r, n = series_metrics(O, P)
+
+out_dir = pathlib.Path('./LSTMSNPCell') / dataset_name
+error_dir = pathlib.Path('./LSTMSNPCell/ERROR') / dataset_name
+out_dir.mkdir(parents=True, exist_ok=True)
+error_dir.mkdir(parents=True, exist_ok=True)
+# 30组结果分别画在同一张 6x5 的子图网格中，每类图只保存一次
+fig4, axes4 = pyplot.subplots(6, 5, figsize=(25, 18), sharex=True)
+fig1, axes1 = pyplot.subplots(6, 5, figsize=(25, 18), sharex=True)
+errors = np.abs(O - P)  # 30组误差一次算出，逐行取用
 for i in range(30):
-    origin = read_csv('./LSTMSNPCell/'+dataset_name+'/origin/' + str(i+1) + '_'+dataset_name1+'.csv', delimiter=',',header=None).values
-    predictions=read_csv('./LSTMSNPCell/'+dataset_name+'/prediction/' + str(i+1) + '_'+dataset_name1+'.csv', delimiter=',',header=None).values
-    rmse = sqrt(mean_squared_error(origin, predictions))
-    mse = mean_squared_error(origin, predictions)
-    meanV = np.mean(origin)  # 对整个origin求取均值返回一个数
-    dominator = np.linalg.norm(predictions - meanV, 2)
-    nmse = mse / np.power(dominator, 2)
-    error = abs(origin - predictions)
-    r.append(rmse)
-    m.append(mse)
-    n.append(nmse)
-    e.append(error)
-
-    fig4 = pyplot.figure()
-    ax41 = fig4.add_subplot(111)
-    pyplot.xticks(fontsize=12)
-    pyplot.yticks(fontsize=12)
-    ax41.set_xlabel("Time", fontsize=12)
-    ax41.set_ylabel("Magnitude", fontsize=12)
-    pyplot.plot(origin, 'k-o', label='the original data')
-    pyplot.plot(predictions, 'k+-', label='the predicted data')
-    pyplot.legend()
-    pyplot.title(dataset_name + "-use 60 datas as test")
-    tt_name = "/home/dell/文档/liuqian/lasttest/Test2/LSTMSNPCell/" + dataset_name + '\\' + dataset_name + '{}.png'
-    pyplot.savefig(tt_name.format(count))
-    count = count + 1
-    pyplot.show()
+    origin = O[i]
+    predictions = P[i]
+    error = errors[i]
+
+    ax41 = axes4.flat[i]
+    ax41.plot(origin, 'k-o', label='the original data', markersize=3, rasterized=True)
+    ax41.plot(predictions, 'k+-', label='the predicted data', markersize=3, rasterized=True)
+    ax41.set_title(f'{dataset_name}{i+1}')
     # # 作图展示2
-    fig1 = pyplot.figure()
-    ax42 = fig1.add_subplot(111)
-    pyplot.xticks(fontsize=15)
-    pyplot.yticks(fontsize=15)
-    ax42.set_xlabel("Time", fontsize=15)
-    ax42.set_ylabel("Magnitude", fontsize=15)
-    pyplot.plot(error, 'k-o', label='the original data-the predicted data')
-    pyplot.legend()
-    pyplot.title(dataset_name + "-use 60 datas error as test")
-    tt_name = "/home/dell/文档/liuqian/lasttest/Test2/LSTMSNPCell/ERROR/" + dataset_name + '\\' + dataset_name + '{}.png'
-    pyplot.savefig(tt_name.format(count1))
-    count1 = count1 + 1
-    pyplot.show()
+    ax42 = axes1.flat[i]
+    ax42.plot(error, 'k-o', label='the original data-the predicted data', markersize=3, rasterized=True)
+    ax42.set_title(f'{dataset_name}{i+1}')
+for fig, axes, title in ((fig4, axes4, "-use 60 datas as test"),
+                         (fig1, axes1, "-use 60 datas error as test")):
+    for ax in axes[-1]:
+        ax.set_xlabel("Time", fontsize=12)
+    for ax in axes[:, 0]:
+        ax.set_ylabel("Magnitude", fontsize=12)
+    fig.legend(*axes.flat[0].get_legend_handles_labels(), loc='upper right')
+    fig.suptitle(dataset_name + title, fontsize=15)
+fig4.savefig(out_dir / f'{dataset_name}.png', dpi=72, pil_kwargs={'compress_level': 1})
+fig1.savefig(error_dir / f'{dataset_name}.png', dpi=72, pil_kwargs={'compress_level': 1})
+pyplot.close(fig4)
+pyplot.close(fig1)
 R=np.var(r)
 M=np.var(m)
 N=np.var(n)
 
-b1 = len(r)
-b2 = len(m)
-b3 = len(n)
-sum1 = 0
-sum2 = 0
-sum3 = 0
-for i in r:
-    sum1 = sum1 +i
-AVGR=(sum1/b1)
-for i in m:
-    sum2 = sum2 +i
-AVGM=(sum2/b2)
-for i in n:
-    sum3 = sum3 +i
-AVGN=(sum3/b3)
-
-
-A=r.index(min(r))+1
-print(r)
-print (dataset_name+' Test RMSE: %.15f ,RMSE: %.15f ,RMSE: %.15f ' %(r[r.index(min(r))],m[r.index(min(r))],n[r.index(min(r))]))
-print(A)
-print(dataset_name+' Test RMSE: %.10f ± %.15f,RMSE: %.10f ± %.15f,RMSE: %.10f ± %.15f' %(AVGR,R,AVGM,M,AVGN,N))
+AVGR=np.mean(r)
+AVGM=np.mean(m)
+AVGN=np.mean(n)
+
+
+best=int(np.argmin(r))
+print(r.tolist())
+print(f'{dataset_name} Test RMSE: {r[best]:.15f} ,MSE: {m[best]:.15f} ,NMSE: {n[best]:.15f} ')
+print(best+1)
+print(dataset_name+' Test RMSE: %.10f ± %.15f,MSE: %.10f ± %.15f,NMSE: %.10f ± %.15f' %(AVGR,R,AVGM,M,AVGN,N))
 
 
 
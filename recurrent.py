@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
+import warnings
+
 import numpy as np
 
 from .. import backend as K
@@ -42,20 +44,18 @@ def _time_distributed_dense(x, w, b=None, dropout=None,
         # apply the same dropout pattern at every timestep
         ones = K.ones_like(K.reshape(x[:, 0, :], (-1, input_dim)))
         dropout_matrix = K.dropout(ones, dropout)
-        expanded_dropout_matrix = K.repeat(dropout_matrix, timesteps)
-        x = K.in_train_phase(x * expanded_dropout_matrix, x, training=training)
+        # (samples, 1, input_dim) broadcasts over time without a tiled copy
+        dropout_matrix = K.expand_dims(dropout_matrix, 1)
+        x = K.in_train_phase(x * dropout_matrix, x, training=training)
 
     # collapse time dimension and batch dimension together
     x = K.reshape(x, (-1, input_dim))
     x = K.dot(x, w)
     if b is not None:
+        # directly on the 2D product, where it fuses into the MatMul
         x = K.bias_add(x, b)
     # reshape to 3D tensor
-    if K.backend() == 'tensorflow':
-        x = K.reshape(x, K.stack([-1, timesteps, output_dim]))
-        x.set_shape([None, None, output_dim])
-    else:
-        x = K.reshape(x, (-1, timesteps, output_dim))
+    x = K.reshape(x, (-1, timesteps, output_dim))
     return x
 
 
@@ -114,6 +114,8 @@ class Recurrent(Layer):
             the RNN will combine the input gate,
             the forget gate and the output gate into a single matrix,
             enabling more time-efficient parallelization on the GPU.
+            For `SimpleRNN`, 2 stacks the input and recurrent kernels
+            so that each timestep needs a single matrix product.
             Note: RNN dropout must be shared for all gates,
             resulting in a slightly reduced regularization.
         input_dim: dimensionality of the input (integer).
@@ -190,6 +192,12 @@ class Recurrent(Layer):
         self.dropout = 0
         self.recurrent_dropout = 0
 
+    def _set_dropout_flags(self):
+        # read the dropout rates once per call: the masks and the
+        # learning-phase tag then agree even if the rates were changed
+        # after construction
+        self._has_dropout = 0 < self.dropout + self.recurrent_dropout
+
     def compute_output_shape(self, input_shape):
         if isinstance(input_shape, list):
             input_shape = input_shape[0]
@@ -212,12 +220,11 @@ class Recurrent(Layer):
 
     def get_initial_states(self, inputs):
         # build an all-zero tensor of shape (samples, output_dim)
-        initial_state = K.zeros_like(inputs)  # (samples, timesteps, input_dim)
-        initial_state = K.sum(initial_state, axis=(1, 2))  # (samples,)
+        initial_state = K.zeros_like(inputs[:, 0, 0])  # (samples,)
         initial_state = K.expand_dims(initial_state)  # (samples, 1)
         initial_state = K.tile(initial_state, [1, self.units])  # (samples, output_dim)
-        initial_states = [initial_state for _ in range(len(self.states))]
-        return initial_states
+        # states are read-only inside the loop, so one tensor serves them all
+        return [initial_state] * len(self.states)
 
     def preprocess_input(self, inputs, training=None):
         return inputs
@@ -255,6 +262,7 @@ class Recurrent(Layer):
         # input shape: `(samples, time (padded with zeros), input_dim)`
         # note that the .build() method of subclasses MUST define
         # self.input_spec and self.state_spec with complete input shapes.
+        self._set_dropout_flags()
         if initial_state is not None:
             if not isinstance(initial_state, (list, tuple)):
                 initial_states = [initial_state]
@@ -303,7 +311,7 @@ class Recurrent(Layer):
             self.add_update(updates, inputs)
 
         # Properly set learning phase
-        if 0 < self.dropout + self.recurrent_dropout:
+        if self._has_dropout:
             last_output._uses_learning_phase = True
             outputs._uses_learning_phase = True
 
@@ -344,7 +352,8 @@ class Recurrent(Layer):
                            for _ in self.states]
             if not states_value:
                 return
-        for i, state in enumerate(self.states):
+        values = []
+        for i in range(len(self.states)):
             if states_value:
                 value = states_value[i]
                 if value.shape != (batch_size, self.units):
@@ -353,8 +362,10 @@ class Recurrent(Layer):
                         ' to have shape ' + str((batch_size, self.units)) +
                         ' but got array with shape ' + str(value.shape))
             else:
-                value = np.zeros((batch_size, self.units))
-            K.set_value(state, value)
+                value = np.zeros((batch_size, self.units), dtype=K.floatx())
+            values.append(value)
+        # upload all states in one round trip
+        K.batch_set_value(list(zip(self.states, values)))
 
     def get_config(self):
         config = {'return_sequences': self.return_sequences,
@@ -363,7 +374,8 @@ class Recurrent(Layer):
                   'unroll': self.unroll,
                   'implementation': self.implementation}
         base_config = super(Recurrent, self).get_config()
-        return dict(list(base_config.items()) + list(config.items()))
+        base_config.update(config)
+        return base_config
 
 
 class SimpleRNN(Recurrent):
@@ -453,6 +465,12 @@ class SimpleRNN(Recurrent):
         self.dropout = min(1., max(0., dropout))
         self.recurrent_dropout = min(1., max(0., recurrent_dropout))
 
+    def _set_dropout_flags(self):
+        super(SimpleRNN, self)._set_dropout_flags()
+        # which dropout masks step applies
+        self._use_dp_mask = self.implementation != 0 and 0 < self.dropout < 1
+        self._use_rec_dp_mask = 0 < self.recurrent_dropout < 1
+
     def build(self, input_shape):
         if isinstance(input_shape, list):
             input_shape = input_shape[0]
@@ -483,56 +501,67 @@ class SimpleRNN(Recurrent):
                                         initializer=self.bias_initializer,
                                         regularizer=self.bias_regularizer,
                                         constraint=self.bias_constraint)
+            self._apply_bias = lambda x: K.bias_add(x, self.bias)
         else:
             self.bias = None
+            self._apply_bias = lambda x: x
+        if self.implementation == 2:
+            self.kernel_concat = K.concatenate([self.kernel,
+                                                self.recurrent_kernel],
+                                               axis=0)
         self.built = True
 
     def preprocess_input(self, inputs, training=None):
         if self.implementation > 0:
             return inputs
         else:
-            input_shape = K.int_shape(inputs)
-            input_dim = input_shape[2]
-            timesteps = input_shape[1]
+            timesteps = K.int_shape(inputs)[1]
             return _time_distributed_dense(inputs,
                                            self.kernel,
                                            self.bias,
                                            self.dropout,
-                                           input_dim,
+                                           self.input_dim,
                                            self.units,
                                            timesteps,
                                            training=training)
 
     def step(self, inputs, states):
-        if self.implementation == 0:
-            h = inputs
-        else:
-            if 0 < self.dropout < 1:
-                h = K.dot(inputs * states[1], self.kernel)
-            else:
-                h = K.dot(inputs, self.kernel)
-            if self.bias is not None:
-                h = K.bias_add(h, self.bias)
-
         prev_output = states[0]
-        if 0 < self.recurrent_dropout < 1:
+        if self._use_rec_dp_mask:
             prev_output *= states[2]
-        output = h + K.dot(prev_output, self.recurrent_kernel)
+
+        if self.implementation == 2:
+            if self._use_dp_mask:
+                inputs = inputs * states[1]
+            # one product of [inputs, prev_output] against the stacked kernels
+            output = K.dot(K.concatenate([inputs, prev_output]),
+                           self.kernel_concat)
+            output = self._apply_bias(output)
+        else:
+            if self.implementation == 0:
+                h = inputs
+            else:
+                if self._use_dp_mask:
+                    h = K.dot(inputs * states[1], self.kernel)
+                else:
+                    h = K.dot(inputs, self.kernel)
+                h = self._apply_bias(h)
+            output = h + K.dot(prev_output, self.recurrent_kernel)
         if self.activation is not None:
             output = self.activation(output)
 
         # Properly set learning phase on output tensor.
-        if 0 < self.dropout + self.recurrent_dropout:
+        if self._has_dropout:
             output._uses_learning_phase = True
         return output, [output]
 
     def get_constants(self, inputs, training=None):
         constants = []
-        if self.implementation == 0 and 0 < self.dropout < 1:
-            input_shape = K.int_shape(inputs)
-            input_dim = input_shape[-1]
+        if self._use_dp_mask:
+            # the inference branch must match the mask's shape, or the
+            # switch loses its static rank
             ones = K.ones_like(K.reshape(inputs[:, 0, 0], (-1, 1)))
-            ones = K.tile(ones, (1, int(input_dim)))
+            ones = K.tile(ones, (1, self.input_dim))
 
             def dropped_inputs():
                 return K.dropout(ones, self.dropout)
@@ -544,7 +573,7 @@ class SimpleRNN(Recurrent):
         else:
             constants.append(K.cast_to_floatx(1.))
 
-        if 0 < self.recurrent_dropout < 1:
+        if self._use_rec_dp_mask:
             ones = K.ones_like(K.reshape(inputs[:, 0, 0], (-1, 1)))
             ones = K.tile(ones, (1, self.units))
 
@@ -575,7 +604,8 @@ class SimpleRNN(Recurrent):
                   'dropout': self.dropout,
                   'recurrent_dropout': self.recurrent_dropout}
         base_config = super(SimpleRNN, self).get_config()
-        return dict(list(base_config.items()) + list(config.items()))
+        base_config.update(config)
+        return base_config
 
 
 class LSTMSNPCell(Recurrent):
@@ -600,6 +630,13 @@ class LSTMSNPCell(Recurrent):
                  recurrent_dropout=0.,
                  **kwargs):
         super(LSTMSNPCell, self).__init__(**kwargs)
+        if self.implementation not in (0, 1, 2):
+            raise ValueError('Unknown `implementation` mode.')
+        if self.implementation == 1:
+            warnings.warn('`implementation=1` is deprecated for `LSTMSNPCell`: '
+                          'it computes exactly what the default '
+                          '`implementation=0` does. Use `implementation=0`.',
+                          DeprecationWarning)
         self.units = units
         self.activation = activations.get(activation)
         self.recurrent_activation = activations.get(recurrent_activation)
@@ -622,6 +659,11 @@ class LSTMSNPCell(Recurrent):
         self.dropout = min(1., max(0., dropout))
         self.recurrent_dropout = min(1., max(0., recurrent_dropout))
 
+    def _set_dropout_flags(self):
+        super(LSTMSNPCell, self)._set_dropout_flags()
+        # whether step masks the recurrent state
+        self._use_rec_dp_mask = 0 < self.recurrent_dropout < 1
+
     def build(self, input_shape):
         if isinstance(input_shape, list):
             input_shape = input_shape[0]
@@ -649,141 +691,80 @@ class LSTMSNPCell(Recurrent):
             constraint=self.recurrent_constraint)
 
         if self.use_bias:
+            if self.unit_forget_bias:
+                def bias_initializer(shape, *args, **kwargs):
+                    return K.concatenate([
+                        self.bias_initializer((self.units,), *args, **kwargs),
+                        initializers.Ones()((self.units,), *args, **kwargs),
+                        self.bias_initializer((self.units * 2,), *args, **kwargs),
+                    ])
+            else:
+                bias_initializer = self.bias_initializer
             self.bias = self.add_weight((self.units * 4,),
                                         name='bias',
-                                        initializer=self.bias_initializer,
+                                        initializer=bias_initializer,
                                         regularizer=self.bias_regularizer,
                                         constraint=self.bias_constraint)
-            if self.unit_forget_bias:
-                bias_value = np.zeros((self.units * 4,))
-                bias_value[self.units: self.units * 2] = 1.
-                K.set_value(self.bias, bias_value)
         else:
             self.bias = None
-
-        self.kernel_r = self.kernel[:, :self.units]
-        self.kernel_c = self.kernel[:, self.units: self.units * 2]
-        self.kernel_o = self.kernel[:, self.units * 2: self.units * 3]
-        self.kernel_a = self.kernel[:, self.units * 3:]
-
-        self.recurrent_kernel_r = self.recurrent_kernel[:, :self.units]
-        self.recurrent_kernel_c = self.recurrent_kernel[:, self.units: self.units * 2]
-        self.recurrent_kernel_o = self.recurrent_kernel[:, self.units * 2: self.units * 3]
-        self.recurrent_kernel_a = self.recurrent_kernel[:, self.units * 3:]
-
-        if self.use_bias:
-            self.bias_r = self.bias[:self.units]
-            self.bias_c = self.bias[self.units: self.units * 2]
-            self.bias_o = self.bias[self.units * 2: self.units * 3]
-            self.bias_a = self.bias[self.units * 3:]
-        else:
-            self.bias_r = None
-            self.bias_c = None
-            self.bias_o = None
-            self.bias_a = None
         self.built = True
 
     def preprocess_input(self, inputs, training=None):
-        if self.implementation == 0:
-            input_shape = K.int_shape(inputs)
-            input_dim = input_shape[2]
-            timesteps = input_shape[1]
-
-            x_r = _time_distributed_dense(inputs, self.kernel_r, self.bias_r,
-                                          self.dropout, input_dim, self.units,
-                                          timesteps, training=training)
-            x_c = _time_distributed_dense(inputs, self.kernel_c, self.bias_c,
-                                          self.dropout, input_dim, self.units,
-                                          timesteps, training=training)
-            x_o = _time_distributed_dense(inputs, self.kernel_o, self.bias_o,
-                                          self.dropout, input_dim, self.units,
-                                          timesteps, training=training)
-            x_a = _time_distributed_dense(inputs, self.kernel_a, self.bias_a,
-                                          self.dropout, input_dim, self.units,
-                                          timesteps, training=training)
-            return K.concatenate([x_r, x_c, x_o, x_a], axis=2)
-        else:
-            return inputs
+        timesteps = K.int_shape(inputs)[1]
+
+        # the input projection of every timestep, for all four gates, as one
+        # product over batch x time; the input dropout mask is shared by all
+        # timesteps, so it is applied here too
+        return _time_distributed_dense(inputs, self.kernel, self.bias,
+                                       self.dropout, self.input_dim,
+                                       self.units * 4, timesteps,
+                                       training=training)
 
     def get_constants(self, inputs, training=None):
         constants = []
-        if self.implementation == 0 and 0 < self.dropout < 1:
-            input_shape = K.int_shape(inputs)
-            input_dim = input_shape[-1]
-            ones = K.ones_like(K.reshape(inputs[:, 0, 0], (-1, 1)))
-            ones = K.tile(ones, (1, int(input_dim)))
-
-            def dropped_inputs():
-                return K.dropout(ones, self.dropout)
-
-            dp_mask = [K.in_train_phase(dropped_inputs,
-                                        ones,
-                                        training=training) for _ in range(4)]
-            constants.append(dp_mask)
-        else:
-            constants.append([K.cast_to_floatx(1.) for _ in range(4)])
-
-        if 0 < self.recurrent_dropout < 1:
+        if self._use_rec_dp_mask:
             ones = K.ones_like(K.reshape(inputs[:, 0, 0], (-1, 1)))
             ones = K.tile(ones, (1, self.units))
 
             def dropped_inputs():
                 return K.dropout(ones, self.recurrent_dropout)
 
-            rec_dp_mask = [K.in_train_phase(dropped_inputs,
-                                            ones,
-                                            training=training) for _ in range(4)]
+            rec_dp_mask = K.in_train_phase(dropped_inputs,
+                                           ones,
+                                           training=training)
             constants.append(rec_dp_mask)
         else:
-            constants.append([K.cast_to_floatx(1.) for _ in range(4)])
+            constants.append(K.cast_to_floatx(1.))
         return constants
 
     def step(self, inputs, states):
         h_tm1 = states[0]
         u_tm1 = states[1]
-        dp_mask = states[2]
-        rec_dp_mask = states[3]
+        rec_dp_mask = states[2]
 
+        if self._use_rec_dp_mask:
+            u_in = u_tm1 * rec_dp_mask
+        else:
+            u_in = u_tm1
+
+        # single recurrent product for all four gates, sliced afterwards
+        z = inputs + K.dot(u_in, self.recurrent_kernel)
+
+        # one activation call over contiguous gate blocks, sliced afterwards
         if self.implementation == 2:
-            z = K.dot(inputs * dp_mask[0], self.kernel)
-            z += K.dot(u_tm1 * rec_dp_mask[0], self.recurrent_kernel)
-            if self.use_bias:
-                z = K.bias_add(z, self.bias)
-
-            z0 = z[:, :self.units]
-            z1 = z[:, self.units: 2 * self.units]
-            z2 = z[:, 2 * self.units: 3 * self.units]
-            z3 = z[:, 3 * self.units:]
-
-            r = self.recurrent_activation(z0)
-            c = self.recurrent_activation(z1)
-            o = self.recurrent_activation(z2)
-            a = self.activation(z3)
+            gates = self.recurrent_activation(z[:, :3 * self.units])
+            a = self.activation(z[:, 3 * self.units:])
         else:
-            if self.implementation == 0:
-                x_r = inputs[:, :self.units]
-                x_c = inputs[:, self.units: 2 * self.units]
-                x_o = inputs[:, 2 * self.units: 3 * self.units]
-                x_a = inputs[:, 3 * self.units:]
-            elif self.implementation == 1:
-                x_r = K.dot(inputs * dp_mask[0], self.kernel_r) + self.bias_r
-                x_c = K.dot(inputs * dp_mask[1], self.kernel_c) + self.bias_c
-                x_o = K.dot(inputs * dp_mask[2], self.kernel_o) + self.bias_o
-                x_a = K.dot(inputs * dp_mask[3], self.kernel_a) + self.bias_a
-            else:
-                raise ValueError('Unknown `implementation` mode.')
-
-            r = self.recurrent_activation(x_r + K.dot(u_tm1 * rec_dp_mask[0],
-                                                      self.recurrent_kernel_r))
-            c = self.recurrent_activation(x_c + K.dot(u_tm1 * rec_dp_mask[1],
-                                                      self.recurrent_kernel_c))
-            o = self.recurrent_activation(x_o + K.dot(u_tm1 * rec_dp_mask[2],
-                                                      self.recurrent_kernel_o))
-            a = self.recurrent_activation(x_a + K.dot(u_tm1 * rec_dp_mask[3],
-                                                      self.recurrent_kernel_a))
+            # implementations 0 and 1 have always used the
+            # recurrent activation for the candidate
+            gates = self.recurrent_activation(z)
+            a = gates[:, 3 * self.units:]
+        r = gates[:, :self.units]
+        c = gates[:, self.units: 2 * self.units]
+        o = gates[:, 2 * self.units: 3 * self.units]
         u = r * u_tm1 - c * a
         h = o * a
-        if 0 < self.dropout + self.recurrent_dropout:
+        if self._has_dropout:
             h._uses_learning_phase = True
         return h, [h, u]
 
@@ -806,7 +787,8 @@ class LSTMSNPCell(Recurrent):
                   'dropout': self.dropout,
                   'recurrent_dropout': self.recurrent_dropout}
         base_config = super(LSTMSNPCell, self).get_config()
-        return dict(list(base_config.items()) + list(config.items()))
+        base_config.update(config)
+        return base_config
 
 
 